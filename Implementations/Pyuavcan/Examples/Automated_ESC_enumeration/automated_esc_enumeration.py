@@ -2,139 +2,220 @@
 
 import uavcan, time
 
+# How long to wait for a response to a service request, in seconds.
+REQUEST_TIMEOUT = 1.0
+
+# Requests that do not depend on the target node are constructed only once.
+OPCODE_SAVE = uavcan.protocol.param.ExecuteOpcode.Request().OPCODE_SAVE
+STOP_ENUMERATION_REQUEST = uavcan.protocol.enumeration.Begin.Request()   # Zero timeout stops the enumeration
+
 
 # Waiting until new nodes stop appearing online.
 # That would mean that all nodes that are connected to the bus are now online and ready to work.
-def wait_for_all_nodes_to_become_online():
-    num_nodes = 0
-    while True:
-        node.spin(timeout=10)
-        new_num_nodes = len(dynamic_node_id_allocator.get_allocation_table())
-        if new_num_nodes == num_nodes and num_nodes > 1:
-            break
+# The node monitor reports every newly discovered node, so there is no need to poll the allocation table.
+# The total waiting time is limited in case new nodes keep appearing, or no nodes appear at all.
+def wait_for_all_nodes_to_become_online(quiet_period=10, timeout=120):
+    online_nodes = set()
+    overall_deadline = time.monotonic() + timeout
+    quiet_deadline = time.monotonic() + quiet_period
+
+    def node_update_callback(event):
+        nonlocal quiet_deadline
+        if event.event_id == event.EVENT_ID_NEW:
+            online_nodes.add(event.entry.node_id)
+            quiet_deadline = time.monotonic() + quiet_period
+
+    handle = node_monitor.add_update_handler(node_update_callback)
+    try:
+        # Waiting for at least one other node, and then until no new nodes have appeared for the quiet period
+        while True:
+            wait_until = min(quiet_deadline, overall_deadline) if online_nodes else overall_deadline
+            remaining = wait_until - time.monotonic()
+            if remaining <= 0:
+                break
+            node.spin(timeout=min(1, remaining))
+    finally:
+        handle.remove()
 
-        num_nodes = new_num_nodes
+    if not online_nodes:
+        raise Exception('No nodes appeared online')
 
 
 # Determining how many ESC nodes are present.
 # In real use cases though the number of ESC should be obtained from elsewhere, e.g. from control mixer settings.
 # There is a helper class in PyUAVCAN that allows one to automate what we're doing here,
 # but we're not using it for the purposes of greater clarity of what's going on on the protocol level.
-def detect_esc_nodes():
+# The stable period must be longer than the slowest expected ESC status publication interval,
+# otherwise slowly publishing ESC may be missed; idle ESC often publish their status at 1 Hz or slower.
+def detect_esc_nodes(timeout=3, stable_period=2):
     esc_nodes = set()
-    handle = node.add_handler(uavcan.equipment.esc.Status, lambda event: esc_nodes.add(event.transfer.source_node_id))
+    last_change_at = time.monotonic()
+
+    def esc_status_callback(event):
+        nonlocal last_change_at
+        if event.transfer.source_node_id not in esc_nodes:
+            esc_nodes.add(event.transfer.source_node_id)
+            last_change_at = time.monotonic()
+
+    handle = node.add_handler(uavcan.equipment.esc.Status, esc_status_callback)
     try:
-        node.spin(timeout=3)            # Collecting ESC status messages, thus determining which nodes are ESC
+        # Collecting ESC status messages, thus determining which nodes are ESC.
+        # Finishing early once the set of detected ESC has not changed for a while.
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            node.spin(timeout=min(0.25, deadline - time.monotonic()))
+            if esc_nodes and time.monotonic() - last_change_at > stable_period:
+                break
     finally:
         handle.remove()
 
     return esc_nodes
 
 
+# Spinning the node until the condition becomes true or until the deadline is reached.
+# The node is spun in short slices so that the condition is re-checked soon after the awaited callback has fired.
+# The last slice is truncated so that the timeout is reported exactly at the deadline.
+def spin_until(condition, deadline):
+    while not condition():
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise Exception('Process timed out')
+        node.spin(min(0.1, remaining))
+
+
 # Enumerating ESC.
 # In this example we're using blocking code for simplicity reasons,
 # but real applications will most likely resort either to asynchronous code (callback-based),
 # or implement the logic in a dedicated thread.
 # Conversion of the code from synchronous to asynchronous/multithreaded pertains to the domain of general
 # programming issues, so these questions are not covered in this demo.
-def enumerate_all_esc(esc_nodes, timeout=60):
-    begin_responses_succeeded = 0
-
-    def begin_response_checker(event):
-        nonlocal begin_responses_succeeded
+# The enumeration state is kept in a class, and the response and message callbacks are its methods.
+class EscEnumerator:
+    def __init__(self, esc_nodes, timeout):
+        self.esc_nodes = esc_nodes
+        self.timeout = timeout
+        self.begin_responses_succeeded = 0
+        self.listening_for_indication = False
+        self.received_indication = None
+        self.remaining_nodes = set(esc_nodes)
+        self.enumerated_nodes = []
+        self.enumerated_set = set()
+        self.next_index = 0
+        self.target_node_id = None
+        self.parameter_name = None
+        self.configuration_finished = False
+
+    def begin_response_checker(self, event):
         if not event:
             raise Exception('Request timed out')
 
         if event.response.error != event.response.ERROR_OK:
             raise Exception('Enumeration rejected\n' + uavcan.to_yaml(event))
 
-        begin_responses_succeeded += 1
+        self.begin_responses_succeeded += 1
+
+    # The indication handler stays installed for the whole enumeration process;
+    # indications that arrive while the previously indicated node is being configured are ignored.
+    def indication_callback(self, event):
+        if not self.listening_for_indication:
+            print('Indication callback from node %d ignored - not listening' % event.transfer.source_node_id)
+        elif event.transfer.source_node_id in self.enumerated_set:
+            print('Indication callback from node %d ignored - already enumerated' % event.transfer.source_node_id)
+        elif event.transfer.source_node_id not in self.remaining_nodes:
+            print('Indication callback from node %d ignored - not a detected ESC' % event.transfer.source_node_id)
+        else:
+            print(uavcan.to_yaml(event))
+            self.received_indication = event
+            self.listening_for_indication = False
 
-    overall_deadline = time.monotonic() + timeout
+    # The configuration of the enumerated node is a chain of requests: stop enumeration, set the parameter, save it.
+    # Each next request is sent from the response callback of the previous one.
+    def stop_response_checker(self, event):
+        if not event:
+            raise Exception('Request timed out')
 
-    print('Starting enumeration on all nodes...')
-    begin_request = uavcan.protocol.enumeration.Begin.Request(timeout_sec=timeout)
-    for node_id in esc_nodes:
-        print('Sending enumeration begin request to', node_id)
-        node.request(begin_request, node_id, begin_response_checker)
-
-    while begin_responses_succeeded < len(esc_nodes):
-        node.spin(0.1)
-
-    print('Listening for indications...')
-    enumerated_nodes = []
-    next_index = 0
-    while set(enumerated_nodes) != esc_nodes:
-        received_indication = None
-
-        def indication_callback(event):
-            nonlocal received_indication
-            if event.transfer.source_node_id in enumerated_nodes:
-                print('Indication callback from node %d ignored - already enumerated' % event.transfer.source_node_id)
-            else:
-                print(uavcan.to_yaml(event))
-                received_indication = event
-
-        indication_handler = node.add_handler(uavcan.protocol.enumeration.Indication, indication_callback)
-        print('=== PROVIDE ENUMERATION FEEDBACK ON ESC INDEX %d NOW ===' % next_index)
-        print('=== e.g. turn the motor, press the button, etc, depending on your equipment ===')
-        try:
-            while received_indication is None:
-                node.spin(0.1)
-                if time.monotonic() > overall_deadline:
-                    raise Exception('Process timed out')
-        finally:
-            indication_handler.remove()
+        if event.response.error != event.response.ERROR_OK:
+            raise Exception('Enumeration stop rejected\n' + uavcan.to_yaml(event))
 
-        target_node_id = received_indication.transfer.source_node_id
-        print('Indication received from node', target_node_id)
+        print('Setting config param %r to %r...' % (self.parameter_name.decode(), self.next_index))
+        node.request(uavcan.protocol.param.GetSet.Request(
+                         value=uavcan.protocol.param.Value(integer_value=self.next_index),
+                         name=self.parameter_name),
+                     self.target_node_id,
+                     self.param_set_response)
 
-        print('Stopping enumeration on node', target_node_id)
-        begin_responses_succeeded = 0
-        node.request(uavcan.protocol.enumeration.Begin.Request(), target_node_id, begin_response_checker)
-        while begin_responses_succeeded < 1:
-            node.spin(0.1)
+    def param_set_response(self, event):
+        if not event:
+            raise Exception('Request timed out')
 
-        print('Setting config param %r to %r...' % (received_indication.message.parameter_name.decode(), next_index))
-        configuration_finished = False
+        assert event.response.name == self.parameter_name
+        assert event.response.value.integer_value == self.next_index
+        print(uavcan.to_yaml(event))
+        node.request(uavcan.protocol.param.ExecuteOpcode.Request(opcode=OPCODE_SAVE),
+                     self.target_node_id,
+                     self.param_opcode_response)
 
-        def param_set_response(event):
-            if not event:
-                raise Exception('Request timed out')
+    def param_opcode_response(self, event):
+        if not event:
+            raise Exception('Request timed out')
 
-            assert event.response.name == received_indication.message.parameter_name
-            assert event.response.value.integer_value == next_index
-            print(uavcan.to_yaml(event))
-            node.request(uavcan.protocol.param.ExecuteOpcode.Request(
-                             opcode=uavcan.protocol.param.ExecuteOpcode.Request().OPCODE_SAVE),
-                         target_node_id,
-                         param_opcode_response)
+        print(uavcan.to_yaml(event))
+        if not event.response.ok:
+            raise Exception('Param opcode execution rejected\n' + uavcan.to_yaml(event))
+        else:
+            self.configuration_finished = True
 
-        def param_opcode_response(event):
-            nonlocal configuration_finished
-            if not event:
-                raise Exception('Request timed out')
+    def run(self):
+        overall_deadline = time.monotonic() + self.timeout
 
-            print(uavcan.to_yaml(event))
-            if not event.response.ok:
-                raise Exception('Param opcode execution rejected\n' + uavcan.to_yaml(event))
-            else:
-                configuration_finished = True
+        print('Starting enumeration on all nodes...')
+        num_esc = len(self.esc_nodes)
+        begin_request = uavcan.protocol.enumeration.Begin.Request(timeout_sec=self.timeout)
+        for node_id in self.esc_nodes:
+            print('Sending enumeration begin request to', node_id)
+            node.request(begin_request, node_id, self.begin_response_checker, timeout=REQUEST_TIMEOUT)
 
-        node.request(uavcan.protocol.param.GetSet.Request(value=uavcan.protocol.param.Value(integer_value=next_index),
-                                                          name=received_indication.message.parameter_name),
-                     target_node_id,
-                     param_set_response)
+        # All requests are in flight now, so the responses are collected at once rather than one by one
+        begin_deadline = min(time.monotonic() + REQUEST_TIMEOUT, overall_deadline)
+        spin_until(lambda: self.begin_responses_succeeded >= num_esc, begin_deadline)
 
-        while not configuration_finished:
-            node.spin(0.1)
+        print('Listening for indications...')
+        indication_handler = node.add_handler(uavcan.protocol.enumeration.Indication, self.indication_callback)
+        try:
+            while self.remaining_nodes:
+                self.enumerate_next(overall_deadline)
+        finally:
+            indication_handler.remove()
+
+        return self.enumerated_nodes
+
+    def enumerate_next(self, overall_deadline):
+        self.received_indication = None
+        self.listening_for_indication = True
+        print('=== PROVIDE ENUMERATION FEEDBACK ON ESC INDEX %d NOW ===' % self.next_index)
+        print('=== e.g. turn the motor, press the button, etc, depending on your equipment ===')
+        spin_until(lambda: self.received_indication is not None, overall_deadline)
 
-        print('Node', target_node_id, 'assigned ESC index', next_index)
-        next_index += 1
-        enumerated_nodes.append(target_node_id)
-        print('Enumerated so far:', enumerated_nodes)
+        self.target_node_id = self.received_indication.transfer.source_node_id
+        # Kept in its raw form, decoded only for printing
+        self.parameter_name = self.received_indication.message.parameter_name
+        print('Indication received from node', self.target_node_id)
 
-    return enumerated_nodes
+        print('Stopping enumeration on node', self.target_node_id)
+        self.configuration_finished = False
+        node.request(STOP_ENUMERATION_REQUEST, self.target_node_id, self.stop_response_checker)
+        spin_until(lambda: self.configuration_finished, overall_deadline)
+
+        print('Node', self.target_node_id, 'assigned ESC index', self.next_index)
+        self.next_index += 1
+        self.enumerated_nodes.append(self.target_node_id)
+        self.enumerated_set.add(self.target_node_id)
+        self.remaining_nodes.discard(self.target_node_id)
+        print('Enumerated so far:', self.enumerated_nodes)
+
+
+def enumerate_all_esc(esc_nodes, timeout=60):
+    return EscEnumerator(esc_nodes, timeout).run()
 
 
 if __name__ == '__main__':
@@ -2,15 +2,43 @@
 
 import uavcan, time, math
 
+# Setpoint publishing period, in seconds.
+PUBLISH_PERIOD = 0.05
+
+# Throttle setpoints for one period of the sine wave are computed once at the publishing rate.
+# The period is 2*pi seconds, rounded to a whole number of publishing periods.
+SETPOINT_TABLE_SIZE = round(2 * math.pi / PUBLISH_PERIOD)
+SETPOINT_TABLE = [int(512 * (math.sin(2 * math.pi * i / SETPOINT_TABLE_SIZE) + 2)) for i in range(SETPOINT_TABLE_SIZE)]
+setpoint_index = 0
+
+# Commanding ESC with indices 0, 1, 2, 3 only.
+# The message is constructed once; only its setpoint values are updated before every broadcast.
+throttle_command = uavcan.equipment.esc.RawCommand(cmd=[0, 0, 0, 0])
+
+
+# Printing ESC status messages to stdout in human-readable YAML format.
+# At most one status message per ESC is printed per STATUS_PRINT_INTERVAL seconds.
+STATUS_PRINT_INTERVAL = 1.0
+status_printed_at = {}
+
+
+def print_esc_status(msg):
+    now = time.monotonic()
+    node_id = msg.transfer.source_node_id
+    if now - status_printed_at.get(node_id, 0) >= STATUS_PRINT_INTERVAL:
+        status_printed_at[node_id] = now
+        print(uavcan.to_yaml(msg))
+
 
 # Publishing setpoint values from this function; it is invoked periodically from the node thread.
 def publish_throttle_setpoint():
+    global setpoint_index
     # Generating a sine wave
-    setpoint = int(512 * (math.sin(time.time()) + 2))
-    # Commanding ESC with indices 0, 1, 2, 3 only
-    commands = [setpoint, setpoint, setpoint, setpoint]
-    message = uavcan.equipment.esc.RawCommand(cmd=commands)
-    node.broadcast(message)
+    setpoint = SETPOINT_TABLE[setpoint_index]
+    setpoint_index = (setpoint_index + 1) % SETPOINT_TABLE_SIZE
+    for esc_index in range(len(throttle_command.cmd)):
+        throttle_command.cmd[esc_index] = setpoint
+    node.broadcast(throttle_command)
 
 
 if __name__ == '__main__':
@@ -24,16 +52,22 @@ if __name__ == '__main__':
     node_monitor = uavcan.app.node_monitor.NodeMonitor(node)
     dynamic_node_id_allocator = uavcan.app.dynamic_node_id.CentralizedServer(node, node_monitor)
 
-    # Waiting for at least one other node to appear online (our local node is already online).
-    while len(dynamic_node_id_allocator.get_allocation_table()) <= 1:
-        print('Waiting for other nodes to become online...')
-        node.spin(timeout=1)
+    # Waiting for at least one other node to appear online.
+    # The node monitor reports every discovered node, so there is no need to poll the allocation table.
+    online_nodes = set()
+    handle = node_monitor.add_update_handler(lambda event: online_nodes.add(event.entry.node_id))
+    try:
+        while not online_nodes:
+            print('Waiting for other nodes to become online...')
+            node.spin(timeout=1)
+    finally:
+        handle.remove()
 
     # This is how we invoke the publishing function periodically.
-    node.periodic(0.05, publish_throttle_setpoint)
+    node.periodic(PUBLISH_PERIOD, publish_throttle_setpoint)
 
-    # Printing ESC status message to stdout in human-readable YAML format.
-    node.add_handler(uavcan.equipment.esc.Status, lambda msg: print(uavcan.to_yaml(msg)))
+    # Printing ESC status messages to stdout.
+    node.add_handler(uavcan.equipment.esc.Status, print_esc_status)
 
     # Running the node until the application is terminated or until first error.
     try: